@@ -1,10 +1,18 @@
+import asyncio
+import base64
+import hashlib
+import hmac
 import time
 import os
-import jwt
+import sys
+import threading
+import httpx
+import orjson
 import requests
 import zhipuai
+from requests.adapters import HTTPAdapter
 
-from typing import Generator, List, Dict
+from typing import AsyncGenerator, Generator, List, Dict, Optional
 from data_types import TextMsgList, MsgList,CharacterMeta
 
 # from api import get_characterglm_response
@@ -16,6 +24,23 @@ load_dotenv()
 # 智谱开放平台API key，参考 https://open.bigmodel.cn/usercenter/apikeys
 API_KEY: str = os.getenv("ZHIPUAI_API_KEY", "")
 
+CHARACTERGLM_URL = "https://open.bigmodel.cn/api/paas/v3/model-api/charglm-3/sse-invoke"
+
+# SSE 增量片段攒够这么多条，或遇到句末标点时才向调用方返回一次
+_SSE_FLUSH_CHUNKS = 8
+_SSE_FLUSH_ENDINGS = ('。', '！', '？')
+_SSE_FLUSH_ENDINGS_BYTES = tuple(e.encode('utf-8') for e in _SSE_FLUSH_ENDINGS)
+
+# 批量请求时的最大并发数
+MAX_CONCURRENT_REQUESTS = int(os.getenv("CHARGLM_MAX_CONCURRENT", "8"))
+
+# chatglm 调用共用的 ZhipuAI 客户端，首次使用时创建
+_ZHIPU_CLIENT: "zhipuai.ZhipuAI | None" = None
+
+# 同步调用共用的 Session，复用到 open.bigmodel.cn 的 TCP/TLS 连接
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32))
+
 class ApiKeyNotSet(ValueError):
     pass
 
@@ -23,66 +48,165 @@ def verify_api_key_not_empty():
     if not API_KEY:
         raise ApiKeyNotSet
 
+# 已签发的 token 缓存，key 为 (apikey, exp_seconds)，value 为 (token, 失效时间)
+_JWT_CACHE: Dict[tuple, tuple] = {}
+_JWT_CACHE_LOCK = threading.Lock()
+# 提前多少秒视为过期，避免请求途中 token 失效
+_JWT_EXPIRY_MARGIN = 60
+# 固定的 HS256 JWT 头部，预先完成 base64url 编码
+_JWT_HEADER_B64 = base64.urlsafe_b64encode(b'{"alg":"HS256","sign_type":"SIGN","typ":"JWT"}').rstrip(b"=")
+
+
+def _b64url(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
 def generate_token(apikey: str, exp_seconds: int) -> str:
     # reference: https://open.bigmodel.cn/dev/api#nosdk
+    now = time.time()
+    key = (apikey, exp_seconds)
+    with _JWT_CACHE_LOCK:
+        cached = _JWT_CACHE.get(key)
+    if cached is not None and cached[1] - now > _JWT_EXPIRY_MARGIN:
+        return cached[0]
+
     try:
         id, secret = apikey.split(".")
     except Exception as e:
         raise Exception("invalid apikey", e)
  
+    timestamp = int(round(now * 1000))
     payload = {
         "api_key": id,
-        "exp": int(round(time.time() * 1000)) + exp_seconds * 1000,
-        "timestamp": int(round(time.time() * 1000)),
+        "exp": timestamp + exp_seconds * 1000,
+        "timestamp": timestamp,
     }
- 
-    return jwt.encode(
-        payload,
-        secret,
-        algorithm="HS256",
-        headers={"alg": "HS256", "sign_type": "SIGN"},
-    )
+
+    # 头部固定为 HS256，直接用 hmac 签名，省去 jwt.encode 的通用处理
+    signing_input = _JWT_HEADER_B64 + b"." + _b64url(orjson.dumps(payload))
+    signature = hmac.new(secret.encode(), signing_input, hashlib.sha256).digest()
+    token = (signing_input + b"." + _b64url(signature)).decode()
+    with _JWT_CACHE_LOCK:
+        _JWT_CACHE[key] = (token, now + exp_seconds)
+    return token
+
+
+def _build_characterglm_request(messages: TextMsgList, meta: CharacterMeta):
+    """构造 characterglm 请求头和请求体，请求体用 orjson 直接序列化为 bytes"""
+    headers = {
+        "Authorization": generate_token(API_KEY, 1800),
+        "Content-Type": "application/json",
+    }
+    body = orjson.dumps({
+        "model": "charglm-3",
+        "meta": meta,
+        "prompt": messages,
+        "incremental": True,
+    })
+    return headers, body
 
 
 def get_characterglm_response(messages: TextMsgList, meta: CharacterMeta) -> Generator[str, None, None]:
     """ 通过http调用characterglm 这段代码的功能是实现通过HTTP调用智谱AI开放平台上的characterglm模型，用于生成基于给定消息和元数据的文本响应"""
     # Reference: https://open.bigmodel.cn/dev/api#characterglm
     verify_api_key_not_empty()
-    url = "https://open.bigmodel.cn/api/paas/v3/model-api/charglm-3/sse-invoke"
-    resp = requests.post(
-        url,
-        headers={"Authorization": generate_token(API_KEY, 1800)},
-        json=dict(
-            model="charglm-3",
-            meta=meta,
-            prompt=messages,
-            incremental=True)
-    )
+    headers, body = _build_characterglm_request(messages, meta)
+    resp = _SESSION.post(CHARACTERGLM_URL, headers=headers, data=body)
     resp.raise_for_status()
     
     # 解析响应（非官方实现）
-    sep = b':'
     last_event = None
+    buf: List[bytes] = []
     for line in resp.iter_lines():
-        if not line or line.startswith(sep):
+        # 空行和以 ':' 开头的注释行 field 为空，不会命中下面的分支
+        field, sep, value = line.partition(b':')
+        if not sep:
             continue
-        field, value = line.split(sep, maxsplit=1)
-        if field == b'event':
+        if field == b'data' and last_event == b'add':
+            buf.append(value)
+            if len(buf) >= _SSE_FLUSH_CHUNKS or value.endswith(_SSE_FLUSH_ENDINGS_BYTES):
+                yield b''.join(buf).decode('utf-8', 'replace')
+                buf.clear()
+        elif field == b'event':
             last_event = value
-        elif field == b'data' and last_event == b'add':
-            yield value.decode()
+    if buf:
+        yield b''.join(buf).decode('utf-8', 'replace')
+
+
+def new_async_client() -> httpx.AsyncClient:
+    """创建异步 httpx 客户端。客户端的连接池绑定在当前事件循环上，应在同一个协程里 async with 使用并向下传递"""
+    return httpx.AsyncClient(
+        timeout=None,
+        limits=httpx.Limits(max_keepalive_connections=16),
+    )
+
+
+async def aget_characterglm_response(
+    messages: TextMsgList,
+    meta: CharacterMeta,
+    client: Optional[httpx.AsyncClient] = None,
+) -> AsyncGenerator[str, None]:
+    """ get_characterglm_response 的异步版本，使用 httpx 流式读取 SSE，不阻塞事件循环。
+    未传入 client 时为本次调用临时创建一个"""
+    verify_api_key_not_empty()
+    if client is None:
+        async with new_async_client() as client:
+            async for chunk in aget_characterglm_response(messages, meta, client):
+                yield chunk
+        return
+
+    headers, body = _build_characterglm_request(messages, meta)
+    async with client.stream("POST", CHARACTERGLM_URL, headers=headers, content=body) as resp:
+        resp.raise_for_status()
 
+        # 解析响应（非官方实现），httpx 已将每行解码为 str
+        last_event = None
+        buf: List[str] = []
+        async for line in resp.aiter_lines():
+            field, sep, value = line.partition(':')
+            if not sep:
+                continue
+            if field == 'data' and last_event == 'add':
+                buf.append(value)
+                if len(buf) >= _SSE_FLUSH_CHUNKS or value.endswith(_SSE_FLUSH_ENDINGS):
+                    yield ''.join(buf)
+                    buf.clear()
+            elif field == 'event':
+                last_event = value
+        if buf:
+            yield ''.join(buf)
+
+
+
+async def aget_complete_response(messages, meta, client: Optional[httpx.AsyncClient] = None):
+    return ''.join([chunk async for chunk in aget_characterglm_response(messages, meta, client)])
+
+
+async def aget_complete_response_batch(batch: List[TextMsgList], meta: CharacterMeta) -> List[str]:
+    """并发获取多组消息的完整回复，并发数由 CHARGLM_MAX_CONCURRENT 限制，结果顺序与输入一致"""
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async with new_async_client() as client:
+        async def _one(messages):
+            async with sem:
+                return await aget_complete_response(messages, meta, client)
+
+        return await asyncio.gather(*[_one(messages) for messages in batch])
 
 
 def get_complete_response(messages, meta):
-    generator = get_characterglm_response(messages, meta)
-    full_response = ''.join(list(generator))
-    return full_response
+    return ''.join(get_characterglm_response(messages, meta))
 
-def get_chatglm_response(messages: List[Dict[str, str]]) -> str:
-    """调用 chatglm 生成角色描述"""
-    from zhipuai import ZhipuAI
-    client = ZhipuAI(api_key=os.getenv("ZHIPUAI_API_KEY", ""))
+def _get_zhipu_client() -> "zhipuai.ZhipuAI":
+    """懒加载的 ZhipuAI 客户端，多次调用共用同一个连接池"""
+    global _ZHIPU_CLIENT
+    if _ZHIPU_CLIENT is None:
+        _ZHIPU_CLIENT = zhipuai.ZhipuAI(api_key=os.getenv("ZHIPUAI_API_KEY", ""))
+    return _ZHIPU_CLIENT
+
+def iter_chatglm(messages: List[Dict[str, str]]) -> Generator[str, None, None]:
+    """调用 chatglm 生成角色描述，逐块返回生成的内容"""
+    client = _get_zhipu_client()
     response = client.chat.completions.create(
         model="glm-3-turbo",
         messages=messages,
@@ -90,8 +214,21 @@ def get_chatglm_response(messages: List[Dict[str, str]]) -> str:
         max_tokens=2000,
         stream=True,
     )
-    full_response = ''.join(chunk.choices[0].delta.content for chunk in response)
-    return full_response
+    for chunk in response:
+        yield chunk.choices[0].delta.content or ''
+
+def get_chatglm_response(messages: List[Dict[str, str]]) -> str:
+    """调用 chatglm 生成角色描述"""
+    return ''.join(iter_chatglm(messages))
+
+def print_stream(parts) -> str:
+    """边生成边打印，返回拼接后的完整文本"""
+    full_response = []
+    for part in parts:
+        print(part, end='', flush=True)
+        full_response.append(part)
+    print()
+    return ''.join(full_response)
 
 def set_user_info():
     print("请设定您想扮演角色的名字:")
@@ -99,8 +236,8 @@ def set_user_info():
     print(f"请输入一些关键词或者特性描述，以帮助生成{user_role}的详细信息（如年龄，职业，性别、个性等）:")
     descreption_keywords = input("角色描述关键词: ")
     messages = [{"role": "user", "content": f"生成一个角色描述，关键词：{descreption_keywords}"}]
-    user_description = get_chatglm_response(messages)
-    print(f"{user_role}的详细信息是：\n{user_description}")
+    print(f"{user_role}的详细信息是：")
+    user_description = print_stream(iter_chatglm(messages))
     return user_role,user_description
 
 def set_bot_info():
@@ -109,14 +246,44 @@ def set_bot_info():
     print(f"请输入一些关键词或者特性描述，以帮助{bot_role}的详细信息（如年龄、职业、性别、个性等）:")
     description_keywords = input("描述关键词: ")
     messages = [{"role": "user", "content": f"生成一个角色描述，关键词：{description_keywords}"}]
-    bot_description = get_chatglm_response(messages)
-    print(f"{bot_role}的详细信息是：\n{bot_description}")
+    print(f"{bot_role}的详细信息是：")
+    bot_description = print_stream(iter_chatglm(messages))
     return bot_role, bot_description
 
-def interactive_chat(meta):
+async def run_in_daemon_thread(func, *args):
+    """在守护线程中执行阻塞调用（如 input），不阻塞事件循环。
+    不使用 asyncio.to_thread：按 Ctrl+C 时 asyncio.run 会等待默认线程池里仍卡在 input() 的线程，导致进程无法退出"""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def set_result(method, value):
+        if not future.done():
+            method(value)
+
+    def run():
+        try:
+            result = func(*args)
+        except BaseException as e:
+            callback = (set_result, future.set_exception, e)
+        else:
+            callback = (set_result, future.set_result, result)
+        try:
+            loop.call_soon_threadsafe(*callback)
+        except RuntimeError:
+            # 事件循环已关闭（例如已按 Ctrl+C 退出），结果直接丢弃
+            pass
+
+    threading.Thread(target=run, daemon=True).start()
+    return await future
+
+async def ainput(prompt: str = "") -> str:
+    """等待用户输入时不阻塞事件循环"""
+    return await run_in_daemon_thread(input, prompt)
+
+async def interactive_chat(meta):
     dialogue = []
-    user_name, user_description = set_user_info()
-    bot_name, bot_description = set_bot_info()
+    user_name, user_description = await run_in_daemon_thread(set_user_info)
+    bot_name, bot_description = await run_in_daemon_thread(set_bot_info)
 
     meta['user_name'] = user_name
     meta['user_info'] = user_description
@@ -124,19 +291,20 @@ def interactive_chat(meta):
     meta['bot_info'] = bot_description
 
     print(f"对话已开始。{bot_name} 将与你对话。输入 '退出' 结束对话。")
-    while True:
-        user_input = input("你: ")
-        if user_input.lower() == '退出':
-            break
-        messages = [{"role": "user", "content": user_input}]
-        try:
-            assistant_response = get_complete_response(messages, meta)
-        except Exception as e:
-            print(f"发生错误: {e}")
-            assistant_response = "抱歉，我暂时无法回答。"
-        dialogue.append(f"用户: {user_input}")
-        dialogue.append(f"{bot_name}: {assistant_response}")
-        print(f"{bot_name}: {assistant_response}")
+    async with new_async_client() as client:
+        while True:
+            user_input = await ainput("你: ")
+            if user_input.lower() == '退出':
+                break
+            messages = [{"role": "user", "content": user_input}]
+            try:
+                assistant_response = await aget_complete_response(messages, meta, client)
+            except Exception as e:
+                print(f"发生错误: {e}")
+                assistant_response = "抱歉，我暂时无法回答。"
+            dialogue.append(f"用户: {user_input}")
+            dialogue.append(f"{bot_name}: {assistant_response}")
+            print(f"{bot_name}: {assistant_response}")
     return '\n'.join(dialogue)
 
 def save_dialogue(dialogue, file_path):
@@ -150,7 +318,14 @@ def main():
         "user_name": "用户",
         "bot_name": ""
     }
-    dialogue = interactive_chat(character_meta)
+    try:
+        dialogue = asyncio.run(interactive_chat(character_meta))
+    except KeyboardInterrupt:
+        # 读取输入的守护线程可能仍阻塞在 input() 上并持有 stdin 的锁，
+        # 正常退出时解释器清理 stdin 会因此中止，这里直接结束进程，不等待该线程
+        print()
+        sys.stdout.flush()
+        os._exit(130)
     save_dialogue(dialogue, 'dialogue.txt')
     print("对话已保存到文件。")
 
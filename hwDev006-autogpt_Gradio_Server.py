@@ -1,5 +1,10 @@
 import os
+import atexit
+import functools
+import queue
+import threading
 import gradio as gr
+import httpx
 
 # 导入相关库
 from langchain.utilities import SerpAPIWrapper
@@ -10,49 +15,158 @@ from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain_experimental.autonomous_agents import AutoGPT
 from langchain.vectorstores import FAISS
 from langchain.docstore import InMemoryDocstore
+from langchain.callbacks.base import BaseCallbackHandler
 
 import faiss
 
 # 初始化环境变量（假设已经在环境中设置）
 # os.environ["SERPAPI_API_KEY"] = os.getenv("SERPAPI_API_KEY")
 
-# 工具初始化
-search = SerpAPIWrapper()
-tools = [
-    Tool(
-        name="search",
-        func=search.run,
-        description="Useful for when you need to answer questions about current events. Ask targeted questions.",
-    ),
-    WriteFileTool(),
-    ReadFileTool(),
-]
-
-# 设置文本嵌入模型和向量存储
-embeddings_model = OpenAIEmbeddings()
-embedding_size = 1536
-index = faiss.IndexFlatL2(embedding_size)
-vectorstore = FAISS(embeddings_model.embed_query, index, InMemoryDocstore({}), {})
-
-# 构建 AutoGPT
-agent = AutoGPT.from_llm_and_tools(
-    ai_name="Jarvis",
-    ai_role="Assistant",
-    tools=tools,
-    llm=ChatOpenAI(model_name="gpt-4", temperature=0, verbose=True),
-    memory=vectorstore.as_retriever(
-        search_type="similarity_score_threshold",
-        search_kwargs={"score_threshold": 0.8}
-    ),
+class RunCancelled(BaseException):
+    """用户停止或断开连接后，用于中止仍在运行的 agent。
+    继承 BaseException：LangChain 回调分发和 AutoGPT.run 执行工具时的 except Exception 都不会拦截它，
+    不会被当作工具报错写进 agent 的对话历史和向量记忆"""
+
+
+# 队列中表示 AutoGPT 开始新一步 LLM 调用的标记
+_STEP_START = object()
+
+
+class AgentRun:
+    """一次 ask_jarvis 调用的状态：token 队列和取消标记"""
+
+    def __init__(self):
+        self.tokens = queue.Queue()
+        self.cancelled = threading.Event()
+
+
+class TokenQueueHandler(BaseCallbackHandler):
+    """按运行 agent 的线程把流式 token 转发到对应请求的队列；请求已取消时抛出 RunCancelled 中止运行"""
+
+    def __init__(self):
+        # 同步回调在调用 LLM/工具的线程中触发，以线程 id 区分各次运行
+        self.runs = {}
+
+    def _current_run(self):
+        run = self.runs.get(threading.get_ident())
+        if run is not None and run.cancelled.is_set():
+            raise RunCancelled()
+        return run
+
+    def on_llm_start(self, serialized, prompts, **kwargs) -> None:
+        run = self._current_run()
+        if run is not None:
+            run.tokens.put(_STEP_START)
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        run = self._current_run()
+        if run is not None:
+            run.tokens.put(token)
+
+    def on_tool_start(self, serialized, input_str, **kwargs) -> None:
+        self._current_run()
+
+_stream_handler = TokenQueueHandler()
+
+# OpenAI 的 LLM 和嵌入调用共用一个 HTTP 客户端，请求之间复用 TCP/TLS 连接
+_http_client = httpx.Client(
+    timeout=60,
+    limits=httpx.Limits(max_keepalive_connections=32),
 )
-# 打印 Auto-GPT 内部的 chain 日志
-agent.chain.verbose = True
+atexit.register(_http_client.close)
+_agent_lock = threading.Lock()
+# 同一个 AutoGPT 实例保存着对话历史，同一时间只允许一次 agent.run
+_run_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=1)
+def _build_agent():
+    # 工具初始化
+    search = SerpAPIWrapper()
+    tools = [
+        Tool(
+            name="search",
+            func=search.run,
+            description="Useful for when you need to answer questions about current events. Ask targeted questions.",
+            callbacks=[_stream_handler],
+        ),
+        WriteFileTool(callbacks=[_stream_handler]),
+        ReadFileTool(callbacks=[_stream_handler]),
+    ]
+
+    # 设置文本嵌入模型和向量存储
+    embeddings_model = OpenAIEmbeddings(http_client=_http_client)
+    embedding_size = 1536
+    # HNSW 近似最近邻索引，检索复杂度约为 O(log N)，避免随记忆增长的暴力 L2 扫描
+    # 向量以 fp16 标量量化存储，内存和距离计算带宽减半，且无需训练
+    index = faiss.IndexHNSWSQ(embedding_size, faiss.ScalarQuantizer.QT_fp16, 32)
+    index.hnsw.efConstruction = 200
+    index.hnsw.efSearch = 64
+    vectorstore = FAISS(embeddings_model.embed_query, index, InMemoryDocstore({}), {})
+
+    # 构建 AutoGPT
+    agent = AutoGPT.from_llm_and_tools(
+        ai_name="Jarvis",
+        ai_role="Assistant",
+        tools=tools,
+        llm=ChatOpenAI(
+            model_name="gpt-4",
+            temperature=0,
+            verbose=True,
+            streaming=True,
+            callbacks=[_stream_handler],
+            http_client=_http_client,
+        ),
+        memory=vectorstore.as_retriever(
+            search_type="similarity_score_threshold",
+            search_kwargs={"score_threshold": 0.8}
+        ),
+    )
+    # 打印 Auto-GPT 内部的 chain 日志
+    agent.chain.verbose = True
+    return agent
+
+def get_agent():
+    """首次调用时才构建工具、向量存储和 AutoGPT，之后复用同一个 agent"""
+    # 加锁避免后台预热和首个请求同时构建两次
+    with _agent_lock:
+        return _build_agent()
+
 def ask_jarvis(question):
+    """在后台线程运行 agent，边生成边把已收到的 token 推给界面，结束后输出最终结果"""
+    run = AgentRun()
+    result = {}
+
+    def work():
+        try:
+            agent = get_agent()
+            with _run_lock:
+                _stream_handler.runs[threading.get_ident()] = run
+                try:
+                    result["response"] = agent.run([question])
+                finally:
+                    del _stream_handler.runs[threading.get_ident()]
+        except RunCancelled:
+            pass
+        except Exception as e:
+            result["response"] = str(e)
+        finally:
+            run.tokens.put(None)
+
+    threading.Thread(target=work, daemon=True).start()
+    partial = ""
     try:
-        response = agent.run([question])
-        return response
-    except Exception as e:
-        return str(e) 
+        while (token := run.tokens.get()) is not None:
+            if token is _STEP_START:
+                # AutoGPT 每一步都会重新调用 LLM，各步输出之间空一行
+                if partial:
+                    partial += "\n\n"
+            else:
+                partial += token
+                yield partial
+    finally:
+        # 正常结束时无影响；界面点了 Stop 或断开时，让 agent 在下一次 LLM 或工具调用时中止
+        run.cancelled.set()
+    yield result.get("response", partial)
 
 # 创建 Gradio 界面
 iface = gr.Interface(
@@ -64,4 +178,6 @@ iface = gr.Interface(
 )
 
 if __name__ == "__main__":
+    # 后台预热 agent，界面启动不必等待，首个请求通常也无需再等构建
+    threading.Thread(target=get_agent, daemon=True).start()
     iface.launch(server_name="0.0.0.0", server_port=7860)
\ No newline at end of file